@@ -6,18 +6,59 @@ __author__ = "Branson Jones"  # replace my name with yours
 __license__ = "MIT"
 __date__ = "February 22, 2024"
 
+import time
+from math import inf
+
 import numpy as np
 
+# score of a quartet holding 0-3 discs of a single player
+QUARTET_SCORES = (0, 1, 10, 100)
+# score of a board where this player has won
+WIN_SCORE = 1000000000
+# [ply % 2] -> sign that turns a score for this player into one for the player to move
+SIGNS = (1, -1)
+
+# transposition table entry flags
+EXACT = 0  # stored score is the true minimax score
+LOWER = 1  # stored score is a lower bound (search failed high)
+UPPER = 2  # stored score is an upper bound (search failed low)
+
+# how many nodes _minimax searches between checks of the clock
+NODES_PER_CLOCK_CHECK = 1024
+
+
+class _SearchTimeout(Exception):
+    """Raised inside _minimax when the time limit for a move runs out."""
+
 
 class ComputerPlayer:
-    def __init__(self, id, difficulty_level):
+    def __init__(self, id, difficulty_level, time_limit=None):
         """
         Constructor, takes a difficulty level (the # of plies to look
         ahead), and a player ID that's either 1 or 2 that tells the player what
-        its number is.
+        its number is. An optional time limit (in seconds) aborts the search
+        once it has been used up, and the move found by the deepest completed
+        search is played instead. The 1-ply search always runs to completion.
         """
         self.ID = id  # which number this player is
+        self._opp = 3 - id  # which number the opponent is
+        self._players = (id, self._opp)  # [ply % 2] -> player to move
         self.MAX_PLIES = difficulty_level  # max number of plies
+        self.time_limit = time_limit  # seconds per move, or None for no limit
+        self._depth = difficulty_level  # plies searched by the current iteration
+        self._deadline = None  # time.perf_counter() value to give up at, or None
+        self._nodes = 0  # nodes searched since the search started
+        self._rng = np.random.default_rng(431)  # seeds the Zobrist keys
+        self._zobrist = None  # [player][col][row] random 64-bit keys
+        self._zobrist_shape = None  # rack shape the keys were built for
+        self._hash = 0  # Zobrist hash of the rack being searched
+        self._bitboards = [0, 0, 0]  # [player] -> bitboard of that player's discs
+        self._line_masks = None  # bitboard mask of every possible quartet
+        self._heights = None  # number of discs in each column of that rack
+        self._total_discs = 0  # number of discs in that rack
+        self._tt = {}  # transposition table: hash -> (depth, score, flag, best_move)
+        self._col_order = ()  # columns in search order
+        self._killer = []  # [ply] -> column of the last cutoff
 
     def pick_move(self, rack):
         """
@@ -28,254 +69,333 @@ class ComputerPlayer:
         drop a disc into.
         """
         shape = (len(rack), len(rack[0]))  # (num_cols, num_rows)
-        # Convert to numpy array
-        numpy_rack = np.full(shape, rack, dtype=int, order='F')
+        ncols, nrows = shape
+        # Convert to numpy array, indexed [col][row] like the rack itself
+        numpy_rack = np.array(rack, dtype=np.int8, order='C')
 
-        if self._rack_full(numpy_rack, shape):
+        # number of discs in each column, i.e. the row the next disc lands in
+        self._heights = (numpy_rack != 0).sum(axis=1).astype(np.int32)
+        self._total_discs = int(self._heights.sum())
+
+        if self._rack_full(shape):
             return None  # no possible move
 
-        i = 0
+        # build Zobrist keys and quartet masks the first time we see a rack of this shape
+        if self._zobrist_shape != shape:
+            self._zobrist = self._rng.integers(0, 2**64, size=(3, ncols, nrows),
+                                               dtype=np.uint64).tolist()
+            self._line_masks = self._build_line_masks(shape)
+            self._zobrist_shape = shape
+        zobrist = self._zobrist
+        hash_key = 0
+        bitboards = [0, 0, 0]
+        for i in range(ncols):
+            for j in range(nrows):
+                player = numpy_rack[i, j]
+                if player != 0:
+                    hash_key ^= zobrist[player][i][j]
+                    bitboards[player] |= 1 << (i*(nrows+1) + j)
+        self._hash = hash_key
+        self._bitboards = bitboards
+        # scores are only comparable within a single search, so start fresh
+        self._tt = {}
+
+        # try center columns first: they are usually strongest, so alpha-beta
+        # finds its cutoffs sooner
+        self._col_order = tuple(sorted(range(ncols), key=lambda c: abs(c - ncols//2)))
+        # column that last caused a cutoff at each ply (killer move heuristic)
+        self._killer = [None] * (self.MAX_PLIES + 1)
+
+        # a mirrored move scores the same as the original on a left-right
+        # symmetric rack, so only search the left half (and the middle)
+        root_order = self._col_order
+        if np.array_equal(numpy_rack, numpy_rack[::-1, :]):
+            root_order = tuple(c for c in root_order if c < (ncols+1)//2)
+
+        # iterative deepening: each search fills the transposition table with
+        # best moves that order the next, deeper one
+        start = time.perf_counter()
+        self._deadline = None
+        self._nodes = 0
+        best_move = self._root_search(shape, 1, root_order, None)
+        if self.time_limit is not None:
+            self._deadline = start + self.time_limit
+        for depth in range(2, self.MAX_PLIES + 1):
+            try:
+                best_move = self._root_search(shape, depth, root_order, best_move)
+            except _SearchTimeout:
+                # out of time: keep the last completed depth's move. The search
+                # state is left mid-move, but it is rebuilt by every pick_move
+                break
+
+        return best_move
+
+    def _root_search(self, shape, depth, col_order, first_move):
+        """
+        Searches the given moves from the current rack to a fixed depth.
+        :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
+        :param depth: int number of plies to look ahead
+        :param col_order: tuple of columns to search, in order
+        :param first_move: column to search first (the best move from the
+            previous iteration), or None
+        :return: the column of the best move
+        """
+        self._depth = depth
+        if first_move is not None:
+            col_order = (first_move,) + tuple(c for c in col_order if c != first_move)
+
+        make = self._make_move
+        unmake = self._unmake_move
+        minimax = self._minimax
+        my_id = self.ID
         best_move = 0
-        high_score = -10000000000
+        high_score = -inf
 
-        while i < shape[0]:
+        for i in col_order:
             # if column is full, skip column
-            if self._make_move(numpy_rack, i, shape, self.ID):
-                score = self._minimax(numpy_rack, shape, 1)
+            if make(i, shape, my_id):
+                score = -minimax(shape, 1, -inf, -high_score)
                 if score > high_score:
                     high_score = score
                     best_move = i
-                self._unmake_move(numpy_rack, i, shape)
-            i += 1
+                unmake(i, shape)
 
         return best_move
 
-    def _minimax(self, rack, shape, ply):
+    def _minimax(self, shape, ply, alpha, beta):
         """
-        A recursive helper method for pick_move() that uses the Minimax algorithm to
-        calculate the best possible move.
-        :param rack: 2D array of ints representing the current board layout.
+        A recursive helper method for pick_move() that uses the Minimax algorithm
+        with alpha-beta pruning to calculate the best possible move. It is
+        written in negamax form: every score is from the point of view of the
+        player whose turn it is at this ply, so max and min share one code path.
         :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
         :param ply: int level of recursion @PRE: Positive, non-zero
-        :return: score that this path will yield assuming optimal play
+        :param alpha: lower bound on the score the player to move is assured of
+        :param beta: upper bound on the score the opponent will allow
+        :return: score that this path will yield for the player to move,
+            assuming optimal play
         """
+        # out of time?
+        deadline = self._deadline
+        if deadline is not None:
+            self._nodes += 1
+            if self._nodes % NODES_PER_CLOCK_CHECK == 0 and time.perf_counter() > deadline:
+                raise _SearchTimeout
+
+        # have we already searched this position deeply enough?
+        max_plies = self._depth
+        tt = self._tt
+        depth = max_plies - ply
+        hash_key = self._hash
+        entry = tt.get(hash_key)
+        tt_move = None
+        if entry is not None:
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if tt_depth >= depth:
+                if tt_flag == EXACT:
+                    return tt_score
+                if tt_flag == LOWER:
+                    alpha = max(alpha, tt_score)
+                else:
+                    beta = min(beta, tt_score)
+                if alpha >= beta:
+                    return tt_score
+        alpha_orig = alpha
+
+        # who makes the next decision? max on even plies, min on odd ones
+        player = self._players[ply & 1]
+        sign = SIGNS[ply & 1]
+
         # check for win
-        score = self._board_state_score(rack, shape)
+        score = self._board_state_score(shape)
         if score[1]:
-            # won on the last move
-            return score[0] / ply
+            # won on the last move: prefer quicker wins and slower losses
+            if score[0] > 0:
+                value = sign * (WIN_SCORE - ply)
+            else:
+                value = sign * (ply - WIN_SCORE)
+            tt[hash_key] = (depth, value, EXACT, None)
+            return value
         # not a win
 
         # check for tie
-        if self._rack_full(rack, shape):
+        if self._rack_full(shape):
             # tie game
+            tt[hash_key] = (depth, 0, EXACT, None)
             return 0
 
         # check if leaf
-        if ply == self.MAX_PLIES:
+        if ply == max_plies:
             # stop recursion
-            score = self._board_state_score(rack, shape)
-            if score[1]:
-                # winner winner
-                return score[0]/ply
-            return score[0]
+            value = sign * score[0]
+            tt[hash_key] = (depth, value, EXACT, None)
+            return value
         # not tie or leaf
 
-        # who makes the next decision?
-        if (ply % 2) == 1:
-            # min's turn:
-            if self.ID == 1:
-                player = 2
-            else:
-                player = 1
-        else:
-            # max's turn
-            player = self.ID
+        # try the best move from a previous search of this position first,
+        # then the last move that caused a cutoff at this ply
+        col_order = self._col_order
+        killers = self._killer
+        killer = killers[ply]
+        if killer is not None:
+            col_order = [killer] + [c for c in col_order if c != killer]
+        if tt_move is not None:
+            col_order = [tt_move] + [c for c in col_order if c != tt_move]
 
-        i = 0
-        high_score = -10000000000
-        low_score = 10000000000
+        make = self._make_move
+        unmake = self._unmake_move
+        minimax = self._minimax
+        value = -inf
+        best_move = None
 
         # iterate through columns
-        while i < shape[0]:
+        for i in col_order:
             # if column is full, skip column
-            if self._make_move(rack, i, shape, player):
-                score = self._minimax(rack, shape, ply+1)
+            if make(i, shape, player):
+                # the opponent's best score is our worst
+                score = -minimax(shape, ply+1, -beta, -alpha)
+                unmake(i, shape)
 
-                if score > high_score:
-                    high_score = score
-                if score < low_score:
-                    low_score = score
+                if score > value:
+                    value = score
+                    best_move = i
+                if value > alpha:
+                    alpha = value
+                if alpha >= beta:
+                    # the opponent will never allow this position: prune
+                    killers[ply] = i
+                    break
 
-                self._unmake_move(rack, i, shape)
-            i += 1
+        # remember the result, noting whether it is exact or only a bound
+        if value <= alpha_orig:
+            flag = UPPER
+        elif value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        tt[hash_key] = (depth, value, flag, best_move)
 
-        # choose score to return
-        if self.ID != player:
-            # min's turn: choose the lowest score
-            return low_score
-        # else, max's turn: choose the highest score
-        return high_score
+        return value
 
-    def _board_state_score(self, rack, shape):
+    def _board_state_score(self, shape):
         """
         Determines aggregate score of a board state. Also determines if a player has won in this state.
-        :param rack: 2D numpy array rack of state being evaluated
+        Quartets holding discs of only one player score 1, 10 or 100 for one,
+        two or three discs, positive for this player and negative for the opponent.
         :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
         :return: (int board_state_score, boolean was_a_win) tuple
         """
-        score = 0
+        bitboards = self._bitboards
+        mine = bitboards[self.ID]
+        theirs = bitboards[self._opp]
+        has_win = self._has_win
 
-        # vertical quartets
-        if shape[1] > 3:
-            for i in range(shape[0]):
-                for j in range((shape[1]-3)):
-                    tmp = self._quartet_score(rack[i][j], rack[i][j+1], rack[i][j+2], rack[i][j+3])
-                    if tmp[1]:
-                        # there is a winner: end score calculation
-                        return tmp
-                    score += tmp[0]
-
-        # horizontal quartets
-        if shape[0] > 3:
-            for i in range((shape[0]-3)):
-                for j in range(shape[1]):
-                    tmp = self._quartet_score(rack[i][j], rack[i+1][j], rack[i+2][j], rack[i+3][j])
-                    if tmp[1]:
-                        # there is a winner: end score calculation
-                        return tmp
-                    score += tmp[0]
-
-        # diagonal quartets
-        if shape[0] > 3 and shape[1] > 3:
-            # bottom-left to top-right
-            for i in range((shape[0]-3)):
-                for j in range((shape[1]-3)):
-                    tmp = self._quartet_score(rack[i][j], rack[i+1][j+1], rack[i+2][j+2], rack[i+3][j+3])
-                    if tmp[1]:
-                        # there is a winner: end score calculation
-                        return tmp
-                    score += tmp[0]
-            # top-left to bottom-right
-            for i in range(3, (shape[0])):
-                for j in range((shape[1]-3)):
-                    tmp = self._quartet_score(rack[i][j], rack[i-1][j+1], rack[i-2][j+2], rack[i-3][j+3])
-                    if tmp[1]:
-                        # there is a winner: end score calculation
-                        return tmp
-                    score += tmp[0]
+        # check for a winner
+        if has_win(mine, shape):
+            return WIN_SCORE, True
+        if has_win(theirs, shape):
+            return -WIN_SCORE, True
+
+        quartet_scores = QUARTET_SCORES
+        score = 0
+        for mask in self._line_masks:
+            my_discs = mine & mask
+            if my_discs:
+                if not theirs & mask:
+                    score += quartet_scores[my_discs.bit_count()]
+            else:
+                their_discs = theirs & mask
+                if their_discs:
+                    score -= quartet_scores[their_discs.bit_count()]
 
         return score, False
 
-    def _quartet_score(self, disc1, disc2, disc3, disc4):
+    @staticmethod
+    def _has_win(bitboard, shape):
         """
-        Determines the score of a set of four sequential disks (a quartet).
-        Also determines if this quartet represents a win.
-        :param disc1: int 0, 1, or 2
-        :param disc2: int 0, 1, or 2
-        :param disc3: int 0, 1, or 2
-        :param disc4: int 0, 1, or 2
-        :return: (int quartet_score, boolean was_a_win)
+        Determines if a bitboard holds four discs in a row. Each column takes
+        num_rows+1 bits, so the empty bit on top of every column keeps lines
+        from wrapping into the next column.
+        :param bitboard: int bitboard of one player's discs
+        :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
+        :return: True if there are four in a row, False otherwise
         """
-        if disc1 == disc2 == disc3 == disc4:
-            # win or empty
-            if disc1 == 0:
-                # empty
-                return 0, False
-            if disc1 == self.ID:
-                # win for max
-                return 1000000000, True
-            else:
-                # win for min
-                return -1000000000, True
-
-        # check for both 1 and 2 in same quartet
-        if ((disc1 == 1 or disc2 == 1 or disc3 == 1 or disc4 == 1)
-                and (disc1 == 2 or disc2 == 2 or disc3 == 2 or disc4 == 2)):
-            return 0, False
-
-        # determine who non-zero discs belong to
-        if disc1 == 1 or disc2 == 1 or disc3 == 1 or disc4 == 1:
-            pid = 1
-        else:
-            pid = 2
-
-        # determine number of zeroes (should be 1-3)
-        zeros = 0
-        if disc1 == 0:
-            zeros += 1
-        if disc2 == 0:
-            zeros += 1
-        if disc3 == 0:
-            zeros += 1
-        if disc4 == 0:
-            zeros += 1
-
-        if zeros == 3:
-            # just one tile
-            if pid == self.ID:
-                return 1, False
-            else:
-                return -1, False
-        if zeros == 2:
-            # two tiles
-            if pid == self.ID:
-                return 10, False
-            else:
-                return -10, False
-        # zeros == 1: three tiles
-        if pid == self.ID:
-            return 100, False
-        else:
-            return -100, False
+        nrows = shape[1]
+        # vertical, horizontal, and the two diagonals
+        for shift in (1, nrows+1, nrows, nrows+2):
+            pairs = bitboard & (bitboard >> shift)
+            if pairs & (pairs >> (2*shift)):
+                return True
+        return False
 
     @staticmethod
-    def _make_move(rack, col, shape, player):
+    def _build_line_masks(shape):
+        """
+        Builds a bitboard mask for every quartet (vertical, horizontal, and
+        diagonal) that fits in a rack.
+        :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
+        :return: tuple of int bitboard masks
+        """
+        height = shape[1] + 1  # bits per column, including the empty top bit
+        masks = []
+        for i in range(shape[0]):
+            for j in range(shape[1]):
+                # (column step, row step): up, right, up-right, down-right
+                for di, dj in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    if 0 <= i + 3*di < shape[0] and 0 <= j + 3*dj < shape[1]:
+                        mask = 0
+                        for k in range(4):
+                            mask |= 1 << ((i + k*di)*height + j + k*dj)
+                        masks.append(mask)
+        return tuple(masks)
+
+    def _make_move(self, col, shape, player):
         """
-        Makes move by altering rack. Will not make move if column is full.
-        :param rack: 2D numpy array rack
+        Makes move by updating the bitboards, Zobrist hash, column heights and
+        disc count. Will not make move if column is full.
         :param col: 0-indexed column number to make move at.
             @PRE: must be valid column number.
         :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
         :param player: 1 or 2
         :return: True if move was made, False if column is full
         """
-        if rack[col][shape[1]-1] != 0:
+        heights = self._heights
+        nrows = shape[1]
+        h = int(heights[col])
+        if h == nrows:
             return False
-        i = 0
-        while i < shape[1]:
-            if rack[col][i] == 0:
-                rack[col][i] = player
-                return True
-            i += 1
+        heights[col] = h + 1
+        self._total_discs += 1
+        self._bitboards[player] |= 1 << (col*(nrows+1) + h)
+        self._hash ^= self._zobrist[player][col][h]
+        return True
 
-    @staticmethod
-    def _unmake_move(rack, col, shape):
+    def _unmake_move(self, col, shape):
         """
-        Unmakes a move by altering rack. Will not unmake move if col specifies an empty column.
-        :param rack: 2D numpy array rack
+        Unmakes a move by updating the bitboards, Zobrist hash, column heights
+        and disc count. Will not unmake move if col specifies an empty column.
         :param col: 0-indexed column number to make move at.
             @PRE: must be valid column number.
         :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
         :return: True if move was unmade, False if col is empty
         """
-        i = shape[1]-1
-        while i >= 0:
-            if rack[col][i] != 0:
-                rack[col][i] = 0
-                return True
-            i -= 1
-        return False
+        heights = self._heights
+        h = int(heights[col])
+        if h == 0:
+            return False
+        h -= 1
+        heights[col] = h
+        self._total_discs -= 1
+        bit = 1 << (col*(shape[1]+1) + h)
+        player = 1 if self._bitboards[1] & bit else 2
+        self._hash ^= self._zobrist[player][col][h]
+        self._bitboards[player] ^= bit
+        return True
 
-    @staticmethod
-    def _rack_full(rack, shape):
+    def _rack_full(self, shape):
         """
         Determines if the rack is full.
-        :param rack: 2D numpy array rack
         :param shape: (num_cols, num_rows) tuple holding dimensions of rack.
         :return: True if full, False otherwise
         """
-        for i in range(shape[0]):
-            if rack[i][shape[1]-1] == 0:
-                return False
-        return True
+        return self._total_discs == shape[0] * shape[1]